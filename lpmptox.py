@@ -20,21 +20,49 @@ Activate your virtualenv and install the requirements::
 
 """
 import click
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fcntl
 import git
+import glob
+import hashlib
+import multiprocessing
 import os
+import selectors
+import shlex
+import shutil
 import subprocess
 from tempfile import TemporaryDirectory
+import time
 import urwid
 
 from lpshipit import (
+    MPListWalker,
     _get_launchpad_client,
-    _set_urwid_widget,
-    summarize_git_mps,
+    _show_mp_picker,
+    get_merge_proposals,
+    iter_mp_summaries,
 )
-from lxc import lxc_container
+from lxc import lxc_container, lxc_container_pool
+
+# RAM backed directory to clone in to when running tox locally so the
+# thousands of files tox writes to .tox never hit the disk
+TMPFS_DIRECTORY = '/dev/shm'
+# Clone to the default temp directory instead when the tmpfs has less than
+# this many bytes free, as tmpfs is usually much smaller than the disk
+TMPFS_MIN_FREE_SPACE = 1024 ** 3
+# Local tox runs keep their virtualenvs here, one work directory per
+# version of the files the virtualenvs are built from
+TOX_CACHE_DIRECTORY = os.path.expanduser('~/.cache/lpshipit/tox')
+TOX_CACHE_INPUT_PATTERNS = ('tox.ini', 'setup.py', 'setup.cfg',
+                            'pyproject.toml', 'requirements*.txt')
+# Cached work directories unused for this many seconds are removed
+TOX_CACHE_MAX_AGE = 30 * 86400
+# Maximum number of MPs tox is run on at the same time
+TOX_MAX_WORKERS = 4
+# Bare mirrors of the source repos the tox clones can borrow objects from
+GIT_MIRROR_DIRECTORY = os.path.expanduser('~/.cache/lpshipit/mirrors')
 
-# Global var to store the chosen MP
-CHOSEN_MP = None
 
 def _write_debug(output_file, message):
     output_file.write('{}\n'.format(message))
@@ -42,22 +70,180 @@ def _write_debug(output_file, message):
     print(message)
 
 
+def _update_git_mirror(source_repo):
+    """Create or update the local bare mirror of ``source_repo``.
+
+    Returns the path of the mirror.
+    """
+    git_mirror = os.path.join(
+        GIT_MIRROR_DIRECTORY,
+        hashlib.sha256(source_repo.encode('utf-8')).hexdigest() + '.git')
+    os.makedirs(GIT_MIRROR_DIRECTORY, exist_ok=True)
+    # Parallel tox runs on the same repo can't update its mirror at once
+    with open(git_mirror + '.lock', 'w') as git_mirror_lock:
+        fcntl.flock(git_mirror_lock, fcntl.LOCK_EX)
+        if os.path.isdir(git_mirror):
+            git.Repo(git_mirror).git.fetch('--prune')
+        else:
+            git.Repo.clone_from(source_repo, git_mirror, mirror=True)
+    return git_mirror
+
+
+def _clone_shallow(source_repo, source_branch, local_repo, **clone_options):
+    try:
+        return git.Repo.clone_from(
+            source_repo,
+            local_repo,
+            depth=1,
+            single_branch=True,
+            branch=source_branch,
+            no_tags=True,
+            **clone_options
+        )
+    except git.GitCommandError:
+        # Not all servers support shallow clones, e.g. dumb http ones
+        return git.Repo.clone_from(
+            source_repo,
+            local_repo,
+            single_branch=True,
+            branch=source_branch,
+            no_tags=True,
+            **clone_options
+        )
+
+
+def _clone_sparse(source_repo, source_branch, local_repo, sparse_paths,
+                  **clone_options):
+    # Only fetch the blobs of the paths we check out
+    repo = git.Repo.clone_from(
+        source_repo,
+        local_repo,
+        depth=1,
+        single_branch=True,
+        branch=source_branch,
+        filter='blob:none',
+        no_checkout=True,
+        no_tags=True,
+        **clone_options
+    )
+    try:
+        repo.git.sparse_checkout('init', '--cone')
+        repo.git.sparse_checkout('set', *sparse_paths)
+    except git.GitCommandError:
+        # Older versions of git don't support sparse-checkout
+        repo.git.config('core.sparseCheckout', 'false')
+    repo.git.checkout(source_branch)
+    return repo
+
+
+def _get_tmp_directory_base(environment):
+    # The repo is pushed to /tmp in lxc containers and must be at the same
+    # path on the host, so only local runs can use tmpfs
+    if environment is None and os.path.isdir(TMPFS_DIRECTORY) \
+            and os.access(TMPFS_DIRECTORY, os.W_OK) \
+            and shutil.disk_usage(TMPFS_DIRECTORY).free >= \
+            TMPFS_MIN_FREE_SPACE:
+        return TMPFS_DIRECTORY
+    return None
+
+
+def _get_tox_cache_key(local_repo):
+    tox_inputs = hashlib.sha256()
+    for pattern in TOX_CACHE_INPUT_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(local_repo, pattern))):
+            with open(path, 'rb') as tox_input:
+                tox_inputs.update(os.path.basename(path).encode('utf-8'))
+                tox_inputs.update(b'\0')
+                tox_inputs.update(tox_input.read())
+                tox_inputs.update(b'\0')
+    return tox_inputs.hexdigest()
+
+
+def _prune_tox_cache():
+    # Work directories that haven't been used for a while are removed,
+    # unless a tox run is using them
+    for tox_workdir_lock_path in glob.glob(
+            os.path.join(TOX_CACHE_DIRECTORY, '*.lock')):
+        try:
+            if time.time() - os.path.getmtime(tox_workdir_lock_path) < \
+                    TOX_CACHE_MAX_AGE:
+                continue
+            with open(tox_workdir_lock_path, 'a') as tox_workdir_lock:
+                fcntl.flock(tox_workdir_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                tox_workdir = tox_workdir_lock_path[:-len('.lock')]
+                shutil.rmtree(tox_workdir, ignore_errors=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tox_workdir + '.complete')
+                os.remove(tox_workdir_lock_path)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+
+
+def _run_cached_tox(local_repo, tox_command, output_file):
+    """Run ``tox_command`` locally, reusing a cached work directory.
+
+    The work directory is picked from the tox inputs of ``local_repo``.
+    The virtualenvs in a work directory were built from the same tox
+    config and requirements so ``--recreate`` is dropped to reuse them, but
+    only if the last tox run in it succeeded. Otherwise, e.g. if tox was
+    interrupted while building them, they're recreated. If another tox run
+    is already using the work directory ``tox_command`` is run as is.
+    """
+    os.makedirs(TOX_CACHE_DIRECTORY, exist_ok=True)
+    _prune_tox_cache()
+    tox_workdir = os.path.join(TOX_CACHE_DIRECTORY,
+                               _get_tox_cache_key(local_repo))
+    tox_workdir_complete = tox_workdir + '.complete'
+    # Opening the lock file also marks the work directory as recently used
+    with open(tox_workdir + '.lock', 'w') as tox_workdir_lock:
+        try:
+            fcntl.flock(tox_workdir_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            _write_debug(output_file, 'Running `{}` in {} ...'.format(
+                tox_command, local_repo))
+            return _run_tox_locally(local_repo, tox_command, output_file)
+        tox_args = [arg for arg in shlex.split(tox_command)
+                    if arg not in ('-r', '--recreate')]
+        if not os.path.exists(tox_workdir_complete):
+            tox_args.append('--recreate')
+        cached_tox_command = shlex.join(tox_args + ['--workdir', tox_workdir])
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tox_workdir_complete)
+        _write_debug(output_file, 'Running `{}` in {} ...'.format(
+            cached_tox_command, local_repo))
+        tox_returncode = _run_tox_locally(local_repo, cached_tox_command,
+                                          output_file)
+        if tox_returncode == 0:
+            open(tox_workdir_complete, 'w').close()
+        return tox_returncode
+
+
 def runtox(source_repo, source_branch,
            tox_command='tox --recreate --parallel auto',
            output_filepath=os.devnull,
-           environment=None):
-    with open(output_filepath, "a") as output_file, TemporaryDirectory() as local_repo:
+           environment=None,
+           sparse_paths=None,
+           git_mirror=False,
+           strict_networking=False):
+    tmp_directory_base = _get_tmp_directory_base(environment)
+    clone_options = {}
+    if git_mirror:
+        # Only the objects missing from the mirror are fetched. lxc clones
+        # are pushed to a container without the mirror so must copy them
+        clone_options['reference_if_able'] = _update_git_mirror(source_repo)
+        clone_options['dissociate'] = environment is not None
+    with open(output_filepath, "a") as output_file, \
+            TemporaryDirectory(dir=tmp_directory_base) as local_repo:
         _write_debug(output_file, 'Cloning {} (branch {}) in to tmp directory {} ...'.format(
             source_repo,
             source_branch,
             local_repo))
-        repo = git.Repo.clone_from(
-            source_repo,
-            local_repo,
-            depth=1,
-            single_branch=True,
-            branch=source_branch
-        )
+        if sparse_paths:
+            repo = _clone_sparse(source_repo, source_branch, local_repo,
+                                 sparse_paths, **clone_options)
+        else:
+            repo = _clone_shallow(source_repo, source_branch, local_repo,
+                                  **clone_options)
         _write_debug(output_file, '{} {}'.format(
             repo.head.object.hexsha,
             repo.head.object.summary
@@ -68,16 +254,15 @@ def runtox(source_repo, source_branch,
                          'Running `{}` in {} lxc environment ...'.format(
                              tox_command, environment))
             return _run_tox_in_lxc(environment, local_repo, tox_command,
-                                   output_file)
+                                   output_file, strict_networking)
         else:
-            _write_debug(output_file,
-                         'Running `{}` in {} ...'.format(tox_command,
-                                                         local_repo))
-            return _run_tox_locally(local_repo, tox_command, output_file)
+            return _run_cached_tox(local_repo, tox_command, output_file)
 
 
-def _run_tox_in_lxc(environment, local_repo, tox_command, output_file):
-    with lxc_container(environment, local_repo) as container:
+def _run_tox_in_lxc(environment, local_repo, tox_command, output_file,
+                    strict_networking=False):
+    with lxc_container(environment, local_repo,
+                       strict_networking=strict_networking) as container:
         # If a proxy has been configured on the host using environment
         # variables http_proxy or https_proxy then the container will inherit
         # this proxy config for the default user. However then calling sudo
@@ -86,9 +271,20 @@ def _run_tox_in_lxc(environment, local_repo, tox_command, output_file):
         # http://manpages.ubuntu.com/manpages/focal/man8/sudo.8.html to pass
         # in a list of environment variables we want set for sudo user too.
         sudo_preserve_proxy = '--preserve-env="http_proxy,https_proxy"'
-        container.run_command('sudo {} apt-get update'.format(sudo_preserve_proxy))
-        container.run_command('sudo {} apt-get install -y python3-pip'.format(sudo_preserve_proxy))
-        container.run_command('sudo {} pip3 install tox'.format(sudo_preserve_proxy))
+        # Reused containers already have tox installed
+        tox_path_returncode, tox_path = container.run_command(
+            ['sh', '-c', 'command -v tox'], live_output=False)
+        if tox_path_returncode != 0:
+            for install_command in ('apt-get update',
+                                    'apt-get install -y python3-pip',
+                                    'pip3 install tox'):
+                install_returncode, install_output = container.run_command(
+                    'sudo {} {}'.format(sudo_preserve_proxy, install_command))
+                if install_returncode != 0:
+                    raise Exception('`{}` failed in {} with return code '
+                                    '{}'.format(install_command,
+                                                container.name,
+                                                install_returncode))
         # local_repo is same path in the container
         tox_returncode, tox_output = container.run_command(
             tox_command + ' -c ' + local_repo)
@@ -97,13 +293,94 @@ def _run_tox_in_lxc(environment, local_repo, tox_command, output_file):
 
 
 def _run_tox_locally(local_repo, tox_command, output_file):
-    process = subprocess.Popen(tox_command,
-                            stdout=subprocess.PIPE,
-                            shell=True,
-                            cwd=local_repo)
-    while process.poll() is None:
-        _write_debug(output_file, process.stdout.readline().decode('utf-8').rstrip())
-    return process.returncode
+    process = subprocess.Popen(shlex.split(tox_command),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=local_repo)
+    # Drain stdout and stderr as output arrives on either of them so
+    # neither pipe can fill up and block tox
+    partial_lines = {process.stdout: b'', process.stderr: b''}
+    with selectors.DefaultSelector() as selector:
+        for pipe in partial_lines:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                pipe = key.fileobj
+                data = pipe.read1(65536)
+                if data:
+                    *lines, partial_lines[pipe] = \
+                        (partial_lines[pipe] + data).split(b'\n')
+                else:
+                    selector.unregister(pipe)
+                    lines = [partial_lines[pipe]] if partial_lines[pipe] \
+                        else []
+                for line in lines:
+                    _write_debug(output_file, line.decode('utf-8').rstrip())
+    return process.wait()
+
+
+def _report_tox_result(mp, tox_returncode):
+    if isinstance(tox_returncode, Exception):
+        print('tox could not be run for {}: {}'.format(mp['web'],
+                                                       tox_returncode))
+    else:
+        print('tox returned {} for {}'.format(tox_returncode, mp['web']))
+
+
+def _runtox_mps_in_turn(mps, **runtox_options):
+    """Run tox on each of ``mps`` in turn, reusing the lxc containers."""
+    tox_returncodes = {}
+    with lxc_container_pool():
+        for mp in mps:
+            # An MP that can't be tested doesn't stop the next ones
+            try:
+                tox_returncode = runtox(mp['source_repo'],
+                                        mp['source_branch'],
+                                        **runtox_options)
+            except Exception as error:
+                tox_returncode = error
+            tox_returncodes[mp['web']] = tox_returncode
+            _report_tox_result(mp, tox_returncode)
+    return tox_returncodes
+
+
+def runtox_mps(mps, environment=None, sparse_paths=None, git_mirror=False,
+               strict_networking=False):
+    """Run tox on several MPs at once, on a pool of processes.
+
+    Each process runs tox on its share of the MPs one after the other so
+    that it can reuse its lxc container from one MP to the next.
+
+    Returns the tox return code of each MP keyed by its web link, or the
+    exception raised if tox couldn't be run on it.
+    """
+    max_workers = min(TOX_MAX_WORKERS, len(mps))
+    # The summarizing threads can still be running when the MPs are chosen,
+    # with their connections and the open summary cache, so the workers
+    # are started afresh rather than forked from this process
+    with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {}
+        for worker in range(max_workers):
+            worker_mps = mps[worker::max_workers]
+            future = executor.submit(_runtox_mps_in_turn, worker_mps,
+                                     environment=environment,
+                                     sparse_paths=sparse_paths,
+                                     git_mirror=git_mirror,
+                                     strict_networking=strict_networking)
+            futures[future] = worker_mps
+        tox_returncodes = {}
+        for future in as_completed(futures):
+            try:
+                tox_returncodes.update(future.result())
+            except Exception as error:
+                # e.g. the worker died or its containers couldn't be deleted
+                for mp in futures[future]:
+                    if mp['web'] not in tox_returncodes:
+                        tox_returncodes[mp['web']] = error
+                        _report_tox_result(mp, error)
+    return tox_returncodes
 
 
 @click.command()
@@ -114,7 +391,19 @@ def _run_tox_locally(local_repo, tox_command, output_file):
 @click.option('--source-branch', help='Branch to test', default=None)
 @click.option('--debug/--no-debug', default=False)
 @click.option('--environment', default=None, help='release (16.04, 18.04, etc) to run tox in')
-def lpmptox(mp_owner, source_repo, source_branch, debug, environment):
+@click.option('--sparse-path', 'sparse_paths', multiple=True,
+              help='Only check out this directory of the source repo, along '
+                   'with the files at its root (may be repeated)')
+@click.option('--git-mirror/--no-git-mirror', default=False,
+              help='Keep a local mirror of the source repo to clone from '
+                   'faster the next time')
+@click.option('--refresh/--no-refresh', default=False,
+              help='Ignore the Merge Proposals retrieved by the last run')
+@click.option('--strict-networking/--no-strict-networking', default=False,
+              help='Wait for lxc containers to reach the Ubuntu archive '
+                   'rather than just to have an IPv4 address')
+def lpmptox(mp_owner, source_repo, source_branch, debug, environment,
+            sparse_paths, git_mirror, refresh, strict_networking):
     """Invokes the commit building with proper user inputs."""
     if not source_repo and not source_branch:
         lp = _get_launchpad_client()
@@ -122,43 +411,45 @@ def lpmptox(mp_owner, source_repo, source_branch, debug, environment):
 
         print('Retrieving Merge Proposals from Launchpad...')
         person = lp.people[lp_user.name if mp_owner is None else mp_owner]
-        mps = person.getMergeProposals(status=['Needs review', 'Approved'])
-        if debug:
-            print('Debug: Launchad returned {} merge proposals'.format(len(mps)))
-        mp_summaries = summarize_git_mps(mps)
+        mps = get_merge_proposals(lp, person,
+                                  status=['Needs review', 'Approved'],
+                                  refresh=refresh)
+        chosen_mps = []
 
-        if mp_summaries:
+        def mps_chosen(button, mps):
+            nonlocal chosen_mps
+            # Nothing to do until at least one MP is checked
+            if not mps:
+                return
+            chosen_mps = mps
 
-            def urwid_exit_on_q(key):
-                if key in ('q', 'Q'):
-                    raise urwid.ExitMainLoop()
+            raise urwid.ExitMainLoop()
 
-            def mp_chosen(button, chosen_mp):
-                global CHOSEN_MP
-                CHOSEN_MP = chosen_mp
-
-                raise urwid.ExitMainLoop()
-
-            listwalker = urwid.SimpleFocusListWalker(list())
-            listwalker.append(urwid.Text(u'Merge Proposal to Merge'))
-            listwalker.append(urwid.Divider())
-
-            for mp in mp_summaries:
-                button = urwid.Button(mp['summary'])
-                urwid.connect_signal(button, 'click', mp_chosen, mp)
-                listwalker.append(button)
-            mp_box = urwid.ListBox(listwalker)
-            try:
-                _set_urwid_widget(mp_box, urwid_exit_on_q)
-            finally:
-                if CHOSEN_MP:
-                    source_repo = CHOSEN_MP['source_repo']
-                    source_branch = CHOSEN_MP['source_branch']
+        listwalker = MPListWalker(u'Merge Proposals to test', [],
+                                  mps_chosen, loading=True,
+                                  choose_label=u'Run tox')
+        no_mps = _show_mp_picker(
+            listwalker, iter_mp_summaries(mps, git_only=True,
+                                          approvers_only=True))
+        if debug:
+            print('Debug: summarized {} merge proposals'.format(
+                len(listwalker.mp_summaries)))
 
-        else:
+        if no_mps:
             print("You have no Merge Proposals in either "
                   "'Needs review' or 'Approved' state")
-    runtox(source_repo, source_branch, environment=environment)
+        if not chosen_mps:
+            return
+        if len(chosen_mps) > 1:
+            runtox_mps(chosen_mps, environment=environment,
+                       sparse_paths=sparse_paths, git_mirror=git_mirror,
+                       strict_networking=strict_networking)
+            return
+        source_repo = chosen_mps[0]['source_repo']
+        source_branch = chosen_mps[0]['source_branch']
+    runtox(source_repo, source_branch, environment=environment,
+           sparse_paths=sparse_paths, git_mirror=git_mirror,
+           strict_networking=strict_networking)
 
 
 if __name__ == "__main__":
@@ -24,109 +24,569 @@ Activate your virtualenv and install the requirements::
 
 
 """
+import contextlib
+import dbm
+import json
 import os
+import queue
 import re
+import shelve
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urlencode
 
 import click
 import git
 import urwid
 
-from launchpadlib.launchpad import Launchpad
-from launchpadlib.credentials import UnencryptedFileCredentialStore
-
 URWID_MAIN_LOOP = None
+URWID_MAIN_LOOP_RUNNING = False
+_LP_CLIENT = None
+_LP_CLIENT_LOCK = threading.Lock()
+# Maximum number of merge proposals summarized concurrently
+SUMMARIZE_MAX_WORKERS = 16
+# launchpadlib browsers are not thread safe so each thread gets its own
+_THREAD_LOCAL = threading.local()
+# On disk cache of MP summaries, keyed by summary options and MP self_link
+MP_CACHE_PATH = os.path.expanduser('~/.cache/lpshipit/mp_summaries')
+# Bump whenever the fields of an MP summary change to ignore older entries
+MP_CACHE_VERSION = 4
+# Cached MP summaries older than this many seconds are recomputed
+MP_CACHE_MAX_AGE = 86400
+# Once the votes of an MP have been unchanged for this many runs they are
+# only re-checked when the MP itself changes or after MP_CACHE_STABLE_MAX_AGE
+MP_CACHE_STABLE_POLLS = 10
+MP_CACHE_STABLE_MAX_AGE = 3600
+# On disk cache of the MPs listed for each owner and set of statuses
+MP_LIST_CACHE_PATH = os.path.expanduser('~/.cache/lpshipit/merge_proposals')
+MP_LIST_CACHE_MAX_AGE = 60
+# Number of entries requested per page of a Launchpad collection, this is
+# the largest batch size the Launchpad API serves
+LP_COLLECTION_PAGE_SIZE = 300
+# str.removeprefix isn't available on the Python 3.8 of the core20 snap
+GIT_BRANCH_REF_PREFIX = 'refs/heads/'
+GIT_BRANCH_REF_PREFIX_LENGTH = len(GIT_BRANCH_REF_PREFIX)
+# Everything up to the Launchpad host in git remote URLs
+LAUNCHPAD_URL_PREFIX_RE = re.compile(r'.*launchpad\.net/')
 
 
 def convert_remotes_to_lp_urls(repo):
     result = []
     for remote in repo.remotes:
         url = remote.url
-        if re.search(r'^lp:', url):
+        if url.startswith('lp:'):
             result.append(remote.url)
         else:
             result.append(
-                re.sub(r'.*launchpad\.net/', 'lp:', url)
+                LAUNCHPAD_URL_PREFIX_RE.sub('lp:', url, count=1)
             )
     return result
 
-def _set_urwid_widget(widget, unhandled_input):
+
+def _get_urwid_main_loop():
     global URWID_MAIN_LOOP
     if URWID_MAIN_LOOP is None:
-        URWID_MAIN_LOOP = urwid.MainLoop(widget, unhandled_input=unhandled_input)
-        URWID_MAIN_LOOP.run()
-    else:
-        URWID_MAIN_LOOP.unhandled_input = unhandled_input
-        URWID_MAIN_LOOP.widget = widget
+        URWID_MAIN_LOOP = urwid.MainLoop(urwid.SolidFill())
+    return URWID_MAIN_LOOP
 
 
-def _get_launchpad_client():
+def _set_urwid_widget(widget, unhandled_input):
+    global URWID_MAIN_LOOP_RUNNING
+    main_loop = _get_urwid_main_loop()
+    main_loop.unhandled_input = unhandled_input
+    main_loop.widget = widget
+    if not URWID_MAIN_LOOP_RUNNING:
+        URWID_MAIN_LOOP_RUNNING = True
+        main_loop.run()
+
+
+def _stream_to_urwid(items, on_item, on_done=None):
+    """Iterate over ``items`` on a background thread.
+
+    Each item is handed to ``on_item`` from within the urwid main loop, so
+    widgets can be updated while the rest of the items are still being
+    produced, and ``on_done`` is called once ``items`` are exhausted. Any
+    exception raised while producing the items is re-raised in the main
+    loop.
+    """
+    produced = queue.Queue()
+    done = object()
+
+    def on_pipe_data(data):
+        while not produced.empty():
+            item = produced.get()
+            if item is done:
+                if on_done is not None:
+                    on_done()
+                return False
+            if isinstance(item, Exception):
+                raise item
+            on_item(item)
+
+    write_fd = _get_urwid_main_loop().watch_pipe(on_pipe_data)
+
+    def produce():
+        try:
+            for item in items:
+                produced.put(item)
+                os.write(write_fd, b'.')
+            produced.put(done)
+        except Exception as error:
+            produced.put(error)
+        finally:
+            # The main loop stops watching the pipe, closing its read end,
+            # as soon as it handles done, possibly on an earlier wake-up
+            with contextlib.suppress(BrokenPipeError):
+                os.write(write_fd, b'.')
+            os.close(write_fd)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+
+class MPListWalker(urwid.ListWalker):
+    """List walker creating the button of an MP only once it's displayed.
+
+    The title and a divider are listed above the MP buttons and clicking
+    a button calls ``on_mp_chosen`` with ``user_args``, the button and the
+    chosen MP summary. If ``loading`` is set a placeholder is listed below
+    the MP buttons until ``mps_loaded`` is called.
+
+    If ``choose_label`` is set several MPs can be chosen instead, each MP
+    gets a check box and ``on_mp_chosen`` is called with the checked MP
+    summaries once the button labelled ``choose_label`` below them is
+    clicked.
+    """
+    def __init__(self, title, mp_summaries, on_mp_chosen, user_args=(),
+                 loading=False, choose_label=None):
+        self.focus = 0
+        self._header = [urwid.Text(title), urwid.Divider()]
+        self._loading = [urwid.Text(u'Loading...')] if loading else []
+        self._footer = []
+        if choose_label is not None:
+            choose_button = urwid.Button(choose_label)
+            urwid.connect_signal(choose_button, 'click',
+                                 self._on_mps_chosen)
+            self._footer = [urwid.Divider(), choose_button]
+        self.mp_summaries = list(mp_summaries)
+        self._on_mp_chosen = on_mp_chosen
+        self._user_args = user_args
+        self._choose_label = choose_label
+        self._buttons = {}
+        # The first MP is focused as MPs are added until the focus is moved
+        self._focus_first_mp = True
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        if position < len(self._header):
+            return self._header[position]
+        index = position - len(self._header)
+        if index >= len(self.mp_summaries):
+            return (self._loading + self._footer)[
+                index - len(self.mp_summaries)]
+        mp = self.mp_summaries[index]
+        button = self._buttons.get(mp['web'])
+        if button is None:
+            if self._choose_label is None:
+                button = urwid.Button(mp['summary'])
+                urwid.connect_signal(button, 'click', self._on_mp_chosen,
+                                     mp, user_args=self._user_args)
+            else:
+                button = urwid.CheckBox(mp['summary'])
+            self._buttons[mp['web']] = button
+        return button
+
+    def _on_mps_chosen(self, button):
+        # MPs that were never displayed have no check box so can't be checked
+        chosen_mps = [mp for mp in self.mp_summaries
+                      if mp['web'] in self._buttons
+                      and self._buttons[mp['web']].get_state()]
+        self._on_mp_chosen(*self._user_args, button, chosen_mps)
+
+    def next_position(self, position):
+        return position + 1
+
+    def prev_position(self, position):
+        return position - 1
+
+    def set_focus(self, position):
+        if self.mp_summaries and position != len(self._header):
+            self._focus_first_mp = False
+        self.focus = position
+        self._modified()
+
+    def add_mp_summary(self, mp):
+        """Add an MP, keeping the most recently created MPs first."""
+        index = len(self.mp_summaries)
+        for other_index, other_mp in enumerate(self.mp_summaries):
+            if other_mp['date_created'] < mp['date_created']:
+                index = other_index
+                break
+        self.mp_summaries.insert(index, mp)
+        # Keep the focus on the same button when an MP is added above it
+        position = index + len(self._header)
+        if self._focus_first_mp:
+            self.focus = len(self._header)
+        elif position <= self.focus and self.focus >= len(self._header):
+            self.focus += 1
+        self._modified()
+
+    def mps_loaded(self):
+        """Remove the loading placeholder once all the MPs were added."""
+        self._loading = []
+        self.focus = min(self.focus,
+                         len(self._header) + len(self.mp_summaries) +
+                         len(self._footer) - 1)
+        self._modified()
+
+
+def _login_to_launchpad():
+    # launchpadlib takes a while to import and isn't needed for --help, so
+    # it's only imported once we log in
+    from launchpadlib.launchpad import Launchpad
+    from launchpadlib.credentials import UnencryptedFileCredentialStore
+
     cred_location = os.path.expanduser('~/.lp_creds')
     credential_store = UnencryptedFileCredentialStore(cred_location)
     return Launchpad.login_with('cpc', 'production', version='devel',
                                 credential_store=credential_store)
 
 
+def _get_launchpad_client():
+    """Return the Launchpad client shared by the whole process."""
+    global _LP_CLIENT
+    with _LP_CLIENT_LOCK:
+        if _LP_CLIENT is None:
+            _LP_CLIENT = _login_to_launchpad()
+    return _LP_CLIENT
+
+
+def _lp_get_json(lp, url, **params):
+    """GET a Launchpad API resource and return its JSON representation.
+
+    This bypasses launchpadlib's lazily loaded entry objects, where every
+    attribute access can be another round trip.
+    """
+    if params:
+        url = '{}?{}'.format(url, urlencode(params, doseq=True))
+    return json.loads(_get_thread_browser(lp).get(url))
+
+
+def _get_thread_browser(lp):
+    """Return a browser for ``lp`` that only the current thread uses.
+
+    The browser shares the credentials and HTTP cache of ``lp`` so threads
+    other than the one that logged in don't have to log in again, which
+    would fetch and parse the WADL of the API once per thread.
+    """
+    browser = getattr(_THREAD_LOCAL, 'browser', None)
+    if browser is None:
+        from lazr.restfulclient._browser import Browser
+
+        connection = lp._browser._connection
+        browser = _THREAD_LOCAL.browser = Browser(
+            lp, lp.credentials, connection.cache, connection.timeout,
+            connection.proxy_info, lp._browser.user_agent,
+            lp._browser.max_retries)
+    return browser
+
+
+def _lp_iter_collection(lp, url, **params):
+    """Yield the entries of a Launchpad collection as dicts.
+
+    Each page is only fetched once the entries of the previous one have
+    been consumed.
+    """
+    collection = _lp_get_json(lp, url, **params)
+    yield from collection['entries']
+    while 'next_collection_link' in collection:
+        collection = _lp_get_json(lp, collection['next_collection_link'])
+        yield from collection['entries']
+
+
+def _lp_get_collection(lp, url, **params):
+    """Return all the entries of a Launchpad collection as dicts."""
+    return list(_lp_iter_collection(lp, url, **params))
+
+
+def _lp_get_linked(lp, entry, name):
+    """Return the JSON representation of the entry linked as ``name``."""
+    return _lp_get_json(lp, entry['{}_link'.format(name)])
+
+
+def _lp_get_shared_linked(lp, entry, name, linked_entries):
+    """Return the entry linked as ``name``, fetching each link only once.
+
+    ``linked_entries`` maps the links already fetched to their entries and
+    can be shared between threads, at worst an entry is fetched twice.
+    """
+    link = entry['{}_link'.format(name)]
+    linked_entry = linked_entries.get(link)
+    if linked_entry is None:
+        linked_entry = linked_entries[link] = _lp_get_json(lp, link)
+    return linked_entry
+
+
+def _get_person_name(lp, entry, name, linked_entries):
+    """Return the name of the person linked as ``name``.
+
+    Person links end with ``~`` followed by the name of the person, so the
+    person is only fetched if the link doesn't.
+    """
+    person_link = entry['{}_link'.format(name)]
+    _, tilde, person_name = person_link.rpartition('/~')
+    if tilde and person_name and '/' not in person_name:
+        return person_name
+    return _lp_get_shared_linked(lp, entry, name, linked_entries)['name']
+
+
+def _parse_lp_datetime(value):
+    return datetime.fromisoformat(value)
+
+
+def _open_cache(path):
+    """Open the shelve at ``path``, or an empty dict if it can't be opened.
+
+    The cache being corrupt, locked by another run or unsupported by the
+    dbm modules available only means running without it.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return shelve.open(path)
+    except dbm.error + (OSError,):
+        return contextlib.nullcontext({})
+
+
+def _cache_merge_proposals(mps, cache_key):
+    # Only cache the MPs once all of them have been retrieved
+    cached_mps = []
+    for mp in mps:
+        cached_mps.append(mp)
+        yield mp
+    with _open_cache(MP_LIST_CACHE_PATH) as cache:
+        cache[cache_key] = {'mps': cached_mps, 'date_cached': time.time()}
+
+
+def get_merge_proposals(lp, person, status, refresh=False):
+    """Iterate over the MPs of ``person`` in any of ``status`` as JSON dicts.
+
+    The MPs are fetched in as few pages as possible rather than one entry
+    at a time, and lazily so the first page can be summarized while the
+    next ones are still being retrieved.
+
+    The MPs retrieved are reused for MP_LIST_CACHE_MAX_AGE seconds unless
+    ``refresh`` is set, so running the commands one after the other
+    doesn't list all the MPs every time.
+    """
+    cache_key = '{}:{}'.format(person.self_link, ','.join(status))
+    if not refresh:
+        with _open_cache(MP_LIST_CACHE_PATH) as cache:
+            cache_entry = cache.get(cache_key)
+        if cache_entry and time.time() - cache_entry['date_cached'] < \
+                MP_LIST_CACHE_MAX_AGE:
+            return iter(cache_entry['mps'])
+    params = {'ws.op': 'getMergeProposals', 'status': status,
+              'ws.size': LP_COLLECTION_PAGE_SIZE}
+    return _cache_merge_proposals(
+        _lp_iter_collection(lp, person.self_link, **params), cache_key)
+
+
+def _get_fresh_cache_entry(cache, key):
+    entry = cache.get(key)
+    if entry and time.time() - entry['date_cached'] < MP_CACHE_MAX_AGE:
+        return entry
+    return None
+
+
+def _mp_fingerprint(mp, votes):
+    # The MP etag doesn't change when a review is added so the etags of
+    # the votes are needed too
+    return mp['http_etag'], tuple(vote['http_etag'] for vote in votes)
+
+
+def _is_stable_cache_entry(cache_entry, mp_etag):
+    return cache_entry['fingerprint'][0] == mp_etag \
+        and cache_entry.get('stable_polls', 0) >= MP_CACHE_STABLE_POLLS \
+        and time.time() - cache_entry['date_checked'] < \
+        MP_CACHE_STABLE_MAX_AGE
+
+
 def _format_git_branch_name(branch_name):
-    if branch_name.startswith('refs/heads/'):
-        return branch_name[len('refs/heads/'):]
+    if branch_name.startswith(GIT_BRANCH_REF_PREFIX):
+        return branch_name[GIT_BRANCH_REF_PREFIX_LENGTH:]
     return branch_name
 
 
-def summarize_git_mps(mps):
-    mp_content = []
-    for mp in mps:
-        if getattr(mp, 'source_git_repository', None):
-            review_vote_parts = []
-            approval_count = 0
-            for vote in mp.votes:
-                if not vote.is_pending:
-                    if vote.comment.vote == 'Approve':
-                        review_vote_parts.append(vote.reviewer.name)
-                        approval_count += 1
-
-            source_repo = mp.source_git_repository
-            target_repo = mp.target_git_repository
-            source_branch = _format_git_branch_name(mp.source_git_path)
-            target_branch = _format_git_branch_name(mp.target_git_path)
-
-            description = '' if not mp.description else mp.description
-            commit_message = description if not mp.commit_message \
-                else mp.commit_message
-
-            short_commit_message = '' if not commit_message \
-                else commit_message.splitlines()[0]
-
-            mp_summary = {
-                'author': mp.registrant.name,
-                'commit_message': commit_message,
-                'short_commit_message': short_commit_message,
-                'reviewers': sorted(review_vote_parts),
-                'approval_count': approval_count,
-                'web': mp.web_link,
-                'target_branch': target_branch,
-                'source_branch': source_branch,
-                'target_repo': target_repo.display_name,
-                'source_repo': source_repo.display_name,
-                'date_created': mp.date_created
-            }
-
-            summary = "{source_repo}/{source_branch}" \
-                      "\n->{target_repo}/{target_branch}" \
-                      "\n    {short_commit_message}" \
-                      "\n    {approval_count} approvals ({str_reviewers})" \
-                      "\n    {date_created} - {web}" \
-                .format(**mp_summary, str_reviewers=","
-                        .join(mp_summary['reviewers']))
-
-            mp_summary['summary'] = summary
-
-            mp_content.append(mp_summary)
-
-    sorted_mps = sorted(mp_content,
-                        key=lambda k: k['date_created'],
-                        reverse=True)
-    return sorted_mps
+def _get_first_line(text):
+    # Only split off the first line rather than every line of the text
+    return text.partition('\n')[0].rstrip('\r') if text else ''
+
+
+def _format_mp_location(repo, branch):
+    return '{}/{}'.format(repo, branch) if repo else branch
+
+
+def _format_mp_summary(mp_summary):
+    """Format the text shown for an MP in the pickers."""
+    source = _format_mp_location(mp_summary['source_repo'],
+                                 mp_summary['source_branch'])
+    target = _format_mp_location(mp_summary['target_repo'],
+                                 mp_summary['target_branch'])
+    return (f"{source}"
+            f"\n->{target}"
+            f"\n    {mp_summary['short_commit_message']}"
+            f"\n    {mp_summary['approval_count']} approvals "
+            f"({mp_summary['reviewers_csv']})"
+            f"\n    {mp_summary['date_created']} - {mp_summary['web']}")
+
+
+def _summarize_mp(lp, mp, votes, approvers_only, linked_entries):
+    # The people and repositories are shared between many MPs and are only
+    # looked up once per run but the comments are unique to each vote
+    def get_shared_linked(entry, name):
+        return _lp_get_shared_linked(lp, entry, name, linked_entries)
+
+    def get_person_name(entry, name):
+        return _get_person_name(lp, entry, name, linked_entries)
+
+    review_vote_parts = []
+    approval_count = 0
+    for vote in votes:
+        if not vote['is_pending']:
+            approved = \
+                _lp_get_linked(lp, vote, 'comment')['vote'] == 'Approve'
+            if approved or not approvers_only:
+                review_vote_parts.append(
+                    get_person_name(vote, 'reviewer'))
+            if approved:
+                approval_count += 1
+
+    description = mp['description'] or ''
+    commit_message = mp['commit_message'] or description
+
+    short_commit_message = _get_first_line(commit_message)
+
+    if mp.get('source_git_repository_link'):
+        source_repo = get_shared_linked(
+            mp, 'source_git_repository')['display_name']
+        target_repo = get_shared_linked(
+            mp, 'target_git_repository')['display_name']
+        source_branch = _format_git_branch_name(mp['source_git_path'])
+        target_branch = _format_git_branch_name(mp['target_git_path'])
+    else:
+        source_repo = ''
+        target_repo = ''
+        source_branch = get_shared_linked(mp, 'source_branch')['display_name']
+        target_branch = get_shared_linked(mp, 'target_branch')['display_name']
+
+    reviewers = sorted(review_vote_parts)
+
+    mp_summary = {
+        'author': get_person_name(mp, 'registrant'),
+        'commit_message': commit_message,
+        'short_commit_message': short_commit_message,
+        'reviewers': reviewers,
+        'reviewers_csv': ",".join(reviewers),
+        'approval_count': approval_count,
+        'web': mp['web_link'],
+        'self_link': mp['self_link'],
+        'target_branch': target_branch,
+        'source_branch': source_branch,
+        'target_repo': target_repo,
+        'source_repo': source_repo,
+        'date_created': _parse_lp_datetime(mp['date_created'])
+    }
+    mp_summary['summary'] = _format_mp_summary(mp_summary)
+    return mp_summary
+
+
+def iter_mp_summaries(mps, git_only=False, approvers_only=False,
+                      repos=None):
+    """Summarize each MP on a pool of worker threads.
+
+    ``mps`` are MP entries as returned by ``get_merge_proposals``. Non git
+    MPs are skipped if ``git_only`` is set and only the MP reviewers who
+    approved it are listed if ``approvers_only`` is set. If ``repos`` is
+    given, git MPs whose source and target repositories are both missing
+    from it are skipped, before any of their votes are fetched. Each worker
+    fetches the votes of an MP with its own Launchpad client and looks up
+    the entries they link to. Summaries are yielded as soon as they are
+    ready, in no particular order.
+
+    Summaries are cached on disk and reused for as long as neither the MP
+    nor its votes change, which skips all of the reviewer, comment and
+    repository lookups for MPs that haven't been touched since the last run.
+    MPs whose votes have been stable for a number of runs don't even have
+    their votes fetched until the MP changes or the check is due again.
+    """
+    def in_repos(mp, cache_entry):
+        if cache_entry:
+            summary = cache_entry['summary']
+            return summary['source_repo'] in repos or \
+                summary['target_repo'] in repos
+        if not mp.get('source_git_repository_link'):
+            return False
+        lp = _get_launchpad_client()
+        return any(
+            _lp_get_shared_linked(lp, mp, name,
+                                  linked_entries)['display_name'] in repos
+            for name in ('source_git_repository', 'target_git_repository'))
+
+    def summarize_mp_entry(mp, cache_entry):
+        if repos is not None and not in_repos(mp, cache_entry):
+            return None
+        if cache_entry and _is_stable_cache_entry(cache_entry,
+                                                  mp['http_etag']):
+            return cache_entry
+        lp = _get_launchpad_client()
+        votes = _lp_get_collection(lp, mp['votes_collection_link'])
+        fingerprint = _mp_fingerprint(mp, votes)
+        if cache_entry and cache_entry['fingerprint'] == fingerprint:
+            return dict(cache_entry,
+                        stable_polls=cache_entry.get('stable_polls', 0) + 1,
+                        date_checked=time.time())
+        return {'fingerprint': fingerprint,
+                'summary': _summarize_mp(lp, mp, votes, approvers_only,
+                                         linked_entries),
+                'stable_polls': 0,
+                'date_cached': time.time(),
+                'date_checked': time.time()}
+
+    linked_entries = {}
+    if git_only:
+        mps = (mp for mp in mps if mp.get('source_git_repository_link'))
+    with _open_cache(MP_CACHE_PATH) as cache, \
+            ThreadPoolExecutor(max_workers=SUMMARIZE_MAX_WORKERS) as executor:
+        futures = {}
+        for mp in mps:
+            cache_key = '{}:{}:{}'.format(MP_CACHE_VERSION, approvers_only,
+                                          mp['self_link'])
+            cache_entry = _get_fresh_cache_entry(cache, cache_key)
+            future = executor.submit(summarize_mp_entry, mp, cache_entry)
+            futures[future] = (cache_key, cache_entry)
+        for future in as_completed(futures):
+            cache_key, cache_entry = futures[future]
+            entry = future.result()
+            if entry is None:
+                continue
+            if entry is not cache_entry:
+                cache[cache_key] = entry
+            yield entry['summary']
+
+
+def resummarize_mp(mp_summary, approvers_only=False):
+    """Summarize the MP of ``mp_summary`` again, bypassing the cache.
+
+    Cached summaries can be out of date, so the MP and its votes are
+    fetched again before going in to a merge commit message.
+    """
+    lp = _get_launchpad_client()
+    mp = _lp_get_json(lp, mp_summary['self_link'])
+    votes = _lp_get_collection(lp, mp['votes_collection_link'])
+    return _summarize_mp(lp, mp, votes, approvers_only, {})
 
 
 def build_commit_msg(author, reviewers, source_branch, target_branch,
@@ -137,6 +597,199 @@ def build_commit_msg(author, reviewers, source_branch, target_branch,
         reviewers, commit_message, mp_web_link)
 
 
+def _urwid_exit_on_q(key):
+    if key in ('q', 'Q'):
+        raise urwid.ExitMainLoop()
+
+
+def _urwid_exit_program(button):
+    raise urwid.ExitMainLoop()
+
+
+def _show_mp_picker(listwalker, mp_summaries):
+    """Show ``listwalker`` while ``mp_summaries`` are streamed in to it.
+
+    Each MP is listed as soon as it's summarized rather than once all of
+    them were retrieved. Returns True if there turned out to be no MPs to
+    pick from, in which case the picker exits on its own.
+    """
+    no_mps = False
+
+    def mps_summarized():
+        nonlocal no_mps
+        listwalker.mps_loaded()
+        if not listwalker.mp_summaries:
+            no_mps = True
+            raise urwid.ExitMainLoop()
+
+    _stream_to_urwid(mp_summaries, listwalker.add_mp_summary, mps_summarized)
+    _set_urwid_widget(urwid.ListBox(listwalker), _urwid_exit_on_q)
+    return no_mps
+
+
+class MergeWizard:
+    """Walks through merging the source branch of an MP in to its target.
+
+    The pickers for the source and target branches are skipped for the
+    branches already given. Before merging, ``fetch`` is the remote to
+    check for changes to the target branch that haven't been pulled yet.
+    """
+    def __init__(self, repo, source_branch=None, target_branch=None,
+                 fetch=None):
+        self.repo = repo
+        self.source_branch = source_branch
+        self.target_branch = target_branch
+        self.fetch = fetch
+        self.chosen_mp = None
+        # The local branches are only looked up if a branch picker is shown
+        self.checkedout_branch = None
+        self.local_branch_positions = None
+        self._branch_buttons = None
+        self._on_branch_chosen = None
+
+    def _load_local_branches(self):
+        try:
+            self.checkedout_branch = self.repo.active_branch
+        except TypeError:
+            # This is OK, it more than likely means a detached HEAD
+            pass
+        # for-each-ref reads the refs in a single git call rather than
+        # GitPython creating a Head for each of them
+        local_branches = [
+            _format_git_branch_name(ref)
+            for ref in self.repo.git.for_each_ref(
+                '--format=%(refname)', GIT_BRANCH_REF_PREFIX).splitlines()]
+        # The branch pickers list the local branches after their title and
+        # a divider, whichever MP is chosen
+        self.local_branch_positions = {
+            local_branch: position
+            for position, local_branch in enumerate(local_branches, 2)}
+        # The source and target branch pickers share the same buttons,
+        # clicking one calls the on_branch_chosen of the picker shown
+        self._branch_buttons = []
+        for local_branch in local_branches:
+            button = urwid.Button(local_branch)
+            urwid.connect_signal(button, 'click', self._branch_chosen,
+                                 local_branch)
+            self._branch_buttons.append(button)
+
+    def _get_branch_focus(self, mp_branch):
+        # The branch of the MP is preferred over the checked out branch
+        focus = self.local_branch_positions.get(mp_branch)
+        if focus is None and self.checkedout_branch \
+                and hasattr(self.checkedout_branch, 'name'):
+            focus = self.local_branch_positions.get(
+                self.checkedout_branch.name)
+        return focus
+
+    def _branch_chosen(self, button, branch):
+        self._on_branch_chosen(button, branch)
+
+    def _show_branch_picker(self, title, mp_branch, on_branch_chosen):
+        self._on_branch_chosen = on_branch_chosen
+        if self._branch_buttons is None:
+            self._load_local_branches()
+        branch_listwalker = urwid.SimpleFocusListWalker(
+            [urwid.Text(title), urwid.Divider()] + self._branch_buttons)
+
+        focus = self._get_branch_focus(mp_branch)
+        if focus:
+            branch_listwalker.set_focus(focus)
+
+        branch_box = urwid.ListBox(branch_listwalker)
+        _set_urwid_widget(branch_box, _urwid_exit_on_q)
+
+    def _show_error(self, error_message):
+        error_text = urwid.Text(error_message)
+        error_box = urwid.Filler(error_text, 'top')
+        _set_urwid_widget(error_box, _urwid_exit_on_q)
+
+    def mp_chosen(self, button, chosen_mp):
+        self.chosen_mp = chosen_mp
+        if not self.source_branch:
+            self._show_branch_picker(u'Source Branch',
+                                     chosen_mp['source_branch'],
+                                     self.source_branch_chosen)
+        else:
+            self.source_branch_chosen(None, self.source_branch)
+
+    def source_branch_chosen(self, button, source_branch):
+        self.source_branch = source_branch
+        if not self.target_branch:
+            self._show_branch_picker(u'Target Branch',
+                                     self.chosen_mp['target_branch'],
+                                     self.target_branch_chosen)
+        else:
+            self.target_branch_chosen(None, self.target_branch)
+
+    def target_branch_chosen(self, button, target_branch):
+        self.target_branch = target_branch
+        source_branch = self.source_branch
+        chosen_mp = self.chosen_mp
+        if target_branch == source_branch:
+            self._show_error('Source branch and target '
+                             'branch can not be the same. '
+                             '\n\nPress Q to exit.')
+            return
+
+        local_git = self.repo.git
+
+        if self.fetch:
+            local_git.fetch(self.fetch)
+            remote_diff = local_git.log(
+                f"{target_branch}..{self.fetch}/{target_branch}",
+                oneline=True)
+            if remote_diff:
+                self._show_error("Remote has unapplied changes.\n"
+                                 "You might need to pull them.\n\n"
+                                 f"{remote_diff}"
+                                 "\n\nPress Q to exit.")
+                return
+
+        # The reviewers go in to the merge commit for good so make sure
+        # they're not from an out of date summary
+        chosen_mp = resummarize_mp(chosen_mp, approvers_only=True)
+        commit_message = build_commit_msg(
+                author=chosen_mp['author'],
+                reviewers=chosen_mp['reviewers_csv'],
+                source_branch=source_branch,
+                target_branch=target_branch,
+                commit_message=chosen_mp[
+                    'commit_message'],
+                mp_web_link=chosen_mp['web']
+        )
+
+        self.repo.branches[target_branch].checkout()
+
+        # The merge output is never shown so don't have git compute a
+        # diffstat of the whole branch for it
+        local_git.execute(
+                ["git", "merge", "--no-ff", "--no-stat",
+                 source_branch, "-m", commit_message])
+
+        merge_summary = "{source_branch} has been merged " \
+                        "in to {target_branch} \nChanges " \
+                        "have _NOT_ been pushed".format(
+                        source_branch=source_branch,
+                        target_branch=target_branch
+                        )
+
+        button = urwid.Button("Exit")
+        urwid.connect_signal(button,
+                             'click',
+                             _urwid_exit_program)
+        merge_summary_listwalker = urwid.SimpleFocusListWalker([
+            urwid.Text(u'Merge Summary'),
+            urwid.Divider(),
+            urwid.Text(merge_summary),
+            urwid.Divider(),
+            button])
+        merge_summary_box = urwid.ListBox(
+                merge_summary_listwalker)
+        _set_urwid_widget(merge_summary_box,
+                          _urwid_exit_on_q)
+
+
 @click.command()
 @click.option('--directory', default=None, help='Path to local directory')
 @click.option('--source-branch', help='Source branch name')
@@ -147,7 +800,10 @@ def build_commit_msg(author, reviewers, source_branch, target_branch,
 @click.option('--debug/--no-debug', default=False)
 @click.option('--fetch', is_flag=False, flag_value="origin", default=None,
               help="fetch from remote before merging")
-def lpshipit(directory, source_branch, target_branch, mp_owner, debug, fetch):
+@click.option('--refresh/--no-refresh', default=False,
+              help='Ignore the Merge Proposals retrieved by the last run')
+def lpshipit(directory, source_branch, target_branch, mp_owner, debug, fetch,
+             refresh):
     """Invokes the commit building with proper user inputs."""
     if not directory:
         directory = os.getcwd()
@@ -163,227 +819,40 @@ def lpshipit(directory, source_branch, target_branch, mp_owner, debug, fetch):
 
     print('Retrieving Merge Proposals from Launchpad...')
     person = lp.people[lp_user.name if mp_owner is None else mp_owner]
-    mps = person.getMergeProposals(status=['Needs review', 'Approved'])
-    if debug:
-        print('Debug: Launchad returned {} merge proposals'.format(len(mps)))
-    mp_summaries = summarize_git_mps(mps)
+    mps = get_merge_proposals(lp, person,
+                              status=['Needs review', 'Approved'],
+                              refresh=refresh)
+    remotes = frozenset(convert_remotes_to_lp_urls(repo))
+    mp_count = 0
+
+    def count_mps(mps):
+        nonlocal mp_count
+        for mp in mps:
+            mp_count += 1
+            yield mp
+
+    merge_wizard = MergeWizard(repo, source_branch=source_branch,
+                               target_branch=target_branch, fetch=fetch)
+    # MPs that aren't related to the chosen directory based on the URLs of
+    # git repo remotes are skipped before summarizing
+    listwalker = MPListWalker(u'Merge Proposal to Merge', [],
+                              merge_wizard.mp_chosen, loading=True)
+    no_mps = _show_mp_picker(
+        listwalker, iter_mp_summaries(count_mps(mps), git_only=True,
+                                      approvers_only=True, repos=remotes))
 
-    if not mp_summaries:
+    if debug:
+        print('Debug: summarized {} of {} merge proposals'.format(
+            len(listwalker.mp_summaries), mp_count))
+    if no_mps and not mp_count:
         print("You have no Merge Proposals in either "
               "'Needs review' or 'Approved' state")
         sys.exit(1)
-
-    # filter MPs that aren't related to the chosen directory based on the
-    # URLs of git repo remotes
-    remotes = convert_remotes_to_lp_urls(repo)
-    mp_summaries = filter(
-        lambda item: item['target_repo'] in remotes or
-                     item['source_repo'] in remotes,
-        mp_summaries
-    )
-
-    if not mp_summaries:
+    if no_mps:
         print("You have no merge proposals matching "
               "repo remote URLs in '%s'" % directory)
         sys.exit(1)
 
-    def urwid_exit_on_q(key):
-        if key in ('q', 'Q'):
-            raise urwid.ExitMainLoop()
-
-    def urwid_exit_program(button):
-        raise urwid.ExitMainLoop()
-
-    def mp_chosen(user_args, button, chosen_mp):
-        source_branch, target_branch, directory, repo, checkedout_branch =\
-            user_args['source_branch'], \
-            user_args['target_branch'], \
-            user_args['directory'], \
-            user_args['repo'], \
-            user_args['checkedout_branch']
-
-        local_branches = [branch.name for branch in repo.branches]
-
-        def source_branch_chosen(user_args, button, chosen_source_branch):
-            chosen_mp, target_branch, directory, repo, checkedout_branch =\
-                user_args['chosen_mp'], \
-                user_args['target_branch'], \
-                user_args['directory'], \
-                user_args['repo'], \
-                user_args['checkedout_branch']
-
-            def target_branch_chosen(user_args, button, target_branch):
-                source_branch, chosen_mp, directory, repo, \
-                checkedout_branch = \
-                    user_args['source_branch'], \
-                    user_args['chosen_mp'], \
-                    user_args['directory'], \
-                    user_args['repo'], \
-                    user_args['checkedout_branch']
-
-                if target_branch != source_branch:
-                    local_git = git.Git(directory)
-
-                    if fetch:
-                        local_git.fetch(fetch)
-                        remote_diff = local_git.log(f"{target_branch}..{fetch}/{target_branch}", oneline=True)
-                        if remote_diff:
-                            error_text = urwid.Text(
-                                "Remote has unapplied changes.\n"
-                                "You might need to pull them.\n\n"
-                                f"{remote_diff}"
-                                "\n\nPress Q to exit.")
-                            error_box = urwid.Filler(error_text, 'top')
-                            _set_urwid_widget(error_box, urwid_exit_on_q)
-                            return
-
-                    commit_message = build_commit_msg(
-                            author=chosen_mp['author'],
-                            reviewers=",".join(
-                                    chosen_mp['reviewers']),
-                            source_branch=source_branch,
-                            target_branch=target_branch,
-                            commit_message=chosen_mp[
-                                'commit_message'],
-                            mp_web_link=chosen_mp['web']
-                    )
-
-                    repo.branches[target_branch].checkout()
-
-                    local_git.execute(
-                            ["git", "merge", "--no-ff", source_branch,
-                             "-m", commit_message])
-
-                    merge_summary = "{source_branch} has been merged " \
-                                    "in to {target_branch} \nChanges " \
-                                    "have _NOT_ been pushed".format(
-                                    source_branch=source_branch,
-                                    target_branch=target_branch
-                                    )
-
-                    merge_summary_listwalker = urwid.SimpleFocusListWalker(
-                        list())
-                    merge_summary_listwalker.append(
-                            urwid.Text(u'Merge Summary'))
-                    merge_summary_listwalker.append(
-                            urwid.Divider())
-                    merge_summary_listwalker.append(
-                            urwid.Text(merge_summary))
-                    merge_summary_listwalker.append(
-                            urwid.Divider())
-                    button = urwid.Button("Exit")
-                    urwid.connect_signal(button,
-                                         'click',
-                                         urwid_exit_program)
-                    merge_summary_listwalker.append(button)
-                    merge_summary_box = urwid.ListBox(
-                            merge_summary_listwalker)
-                    _set_urwid_widget(merge_summary_box,
-                                      urwid_exit_on_q)
-                else:
-                    error_text = urwid.Text('Source branch and target '
-                                            'branch can not be the same. '
-                                            '\n\nPress Q to exit.')
-                    error_box = urwid.Filler(error_text, 'top')
-                    _set_urwid_widget(error_box, urwid_exit_on_q)
-
-            user_args = {'chosen_mp': chosen_mp,
-                         'source_branch': chosen_source_branch,
-                         'directory': directory,
-                         'repo': repo,
-                         'checkedout_branch': checkedout_branch}
-            if not target_branch:
-                target_branch_listwalker = urwid.SimpleFocusListWalker(
-                    list())
-                target_branch_listwalker.append(
-                        urwid.Text(u'Target Branch'))
-                target_branch_listwalker.append(urwid.Divider())
-                focus_counter = 1
-                focus = None
-                for local_branch in local_branches:
-                    focus_counter = focus_counter + 1
-                    button = urwid.Button(local_branch)
-                    urwid.connect_signal(button,
-                                         'click',
-                                         target_branch_chosen,
-                                         local_branch,
-                                         user_args=[user_args])
-                    target_branch_listwalker.append(button)
-
-                    if local_branch == chosen_mp['target_branch']:
-                        focus = focus_counter
-                    if checkedout_branch \
-                            and hasattr(checkedout_branch, 'name') \
-                            and local_branch == checkedout_branch.name \
-                            and focus is None:
-                        focus = focus_counter
-
-                if focus:
-                    target_branch_listwalker.set_focus(focus)
-
-                target_branch_box = urwid.ListBox(target_branch_listwalker)
-                _set_urwid_widget(target_branch_box, urwid_exit_on_q)
-            else:
-                target_branch_chosen(user_args, None, target_branch)
-        user_args = {'chosen_mp': chosen_mp,
-                     'target_branch': target_branch,
-                     'directory': directory,
-                     'repo': repo,
-                     'checkedout_branch': checkedout_branch}
-        if not source_branch:
-            source_branch_listwalker = urwid.SimpleFocusListWalker(list())
-            source_branch_listwalker.append(urwid.Text(u'Source Branch'))
-            source_branch_listwalker.append(urwid.Divider())
-            focus_counter = 1
-            focus = None
-            for local_branch in local_branches:
-                focus_counter = focus_counter + 1
-                button = urwid.Button(local_branch)
-                urwid.connect_signal(button, 'click',
-                                     source_branch_chosen,
-                                     local_branch,
-                                     user_args=[user_args])
-                source_branch_listwalker.append(button)
-                if local_branch == chosen_mp['source_branch']:
-                    focus = focus_counter
-                if checkedout_branch \
-                        and hasattr(checkedout_branch, 'name') \
-                        and local_branch == checkedout_branch.name \
-                        and focus is None:
-                    focus = focus_counter
-
-            if focus:
-                source_branch_listwalker.set_focus(focus)
-
-            source_branch_box = urwid.ListBox(source_branch_listwalker)
-            _set_urwid_widget(source_branch_box, urwid_exit_on_q)
-        else:
-            source_branch_chosen(user_args, None, source_branch)
-
-    checkedout_branch = None
-    try:
-        checkedout_branch = repo.active_branch
-    except TypeError:
-        # This is OK, it more than likely means a detached HEAD
-        pass
-    listwalker = urwid.SimpleFocusListWalker(list())
-    listwalker.append(urwid.Text(u'Merge Proposal to Merge'))
-    listwalker.append(urwid.Divider())
-    user_args = {'source_branch': source_branch,
-                 'target_branch': target_branch,
-                 'directory': directory,
-                 'repo': repo,
-                 'checkedout_branch': checkedout_branch
-                 }
-
-    for mp in mp_summaries:
-        button = urwid.Button(mp['summary'])
-        urwid.connect_signal(button, 'click', mp_chosen, mp,
-                             user_args=[user_args])
-        listwalker.append(button)
-    mp_box = urwid.ListBox(listwalker)
-    _set_urwid_widget(mp_box, urwid_exit_on_q)
-
 
 if __name__ == "__main__":
     lpshipit()
@@ -1,95 +1,276 @@
+import codecs
 import contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
 import os
+import re
+import shlex
 import subprocess
 import time
+import uuid
+
+# Seconds to wait for networking to come up in a new container, retrying
+# after a delay which doubles from NETWORKING_FIRST_RETRY_DELAY each time, up
+# to NETWORKING_MAX_RETRY_DELAY
+NETWORKING_TIMEOUT = 60
+NETWORKING_FIRST_RETRY_DELAY = 0.25
+NETWORKING_MAX_RETRY_DELAY = 8
+# Seconds to let each request to the archive take while checking networking
+NETWORKING_CHECK_TIMEOUT = 2
+# Maximum number of bytes of command output to read at a time
+RUN_COMMAND_READ_SIZE = 65536
+# Written on a line of its own after the output of each command run in a
+# container, followed by the command's return code. It's formatted with a
+# random nonce for each command so no output can be mistaken for it.
+RUN_COMMAND_END = '__lpshipit_returncode_{}__'
+# Home directory on the host, whose ~/.ssh and ~/.gitconfig are pushed to
+# each container
+HOME = os.path.expanduser('~')
+# Containers kept for reuse by lxc_container_pool, keyed by environment
+_CONTAINER_POOL = None
 
 
 class LxcContainer:
-    def __init__(self, environment, name):
+    def __init__(self, environment, name, strict_networking=False):
         self.name = name
+        self.strict_networking = strict_networking
+        self._shell = None
+        self._unread_output = b''
         image = 'ubuntu:{}'.format(environment)
-        subprocess.check_output('lxc launch {} {}'.format(image,name), 
-                                stdin=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                shell=True) 
+        subprocess.check_call(['lxc', 'launch', image, name],
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL)
         self.wait_for_networking()
-        self.user = subprocess.check_output('lxc exec {} -- whoami'.format(self.name),
-                                            stdin=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT,
-                                            shell=True).decode('utf-8').strip()
-        self.home = subprocess.check_output('lxc exec {} -- pwd'.format(self.name),
-                                             stdin=subprocess.PIPE,
-                                             stderr=subprocess.STDOUT,
-                                             shell=True).decode('utf-8').strip()
+        # Look up the default user and its home directory in one call
+        self.user, self.home = subprocess.check_output(
+            ['lxc', 'exec', self.name, '--', 'sh', '-c', 'whoami; pwd'],
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT).decode('utf-8').split()
+
+    def has_ipv4_address(self):
+        # lxc list matches containers by name prefix so query the state of
+        # this container alone
+        state = json.loads(subprocess.check_output(
+            ['lxc', 'query', '/1.0/instances/{}/state'.format(self.name)],
+            stdin=subprocess.DEVNULL))
+        return any(address['family'] == 'inet'
+                   and address['scope'] == 'global'
+                   for network in (state.get('network') or {}).values()
+                   for address in network['addresses'])
 
     def wait_for_networking(self):
-        for _ in range(10):
-            check_networking_returncode, check_networking_output = \
-                self.run_command(
-                    'sh -c "curl -s --head '
-                    'http://archive.ubuntu.com > /dev/null"')
-            if check_networking_returncode == 0:
+        deadline = time.monotonic() + NETWORKING_TIMEOUT
+        delay = NETWORKING_FIRST_RETRY_DELAY
+        while True:
+            # Asking lxc for the container's addresses doesn't leave the host
+            # so only check the archive can be reached if strict_networking
+            # is set
+            if self.has_ipv4_address() and (not self.strict_networking or
+                                            self.archive_is_reachable()):
                 return  # We have networking, exit out
-            time.sleep(6)
-        raise Exception('Networking did not come up in 60 seconds')
-    
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception('Networking did not come up in {} '
+                                'seconds'.format(NETWORKING_TIMEOUT))
+            # The last check is made right at the deadline
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, NETWORKING_MAX_RETRY_DELAY)
+
+    def archive_is_reachable(self):
+        # Resolving the archive is much cheaper than fetching from it so
+        # only try fetching once it resolves
+        resolve_returncode, resolve_output = self.run_command(
+            ['getent', 'hosts', 'archive.ubuntu.com'],
+            live_output=False)
+        if resolve_returncode != 0:
+            return False
+        check_networking_returncode, check_networking_output = \
+            self.run_command(['curl', '-sSf', '--head',
+                              '--max-time', str(NETWORKING_CHECK_TIMEOUT),
+                              '-o', '/dev/null',
+                              'http://archive.ubuntu.com'],
+                             live_output=False)
+        return check_networking_returncode == 0
+
+    def push_files(self, directory, names, destination):
+        """Copy the ``names`` in ``directory`` to ``destination``.
+
+        The files are streamed in to the container in a single tar archive
+        rather than pushed one at a time, falling back to ``lxc file push``
+        if that fails.
+        """
+        tar_cmd = ['tar', '-cf', '-', '-C', directory] + names
+        untar_cmd = ['lxc', 'exec', self.name, '--',
+                     'tar', '-xf', '-', '-C', destination]
+        print('{} | {}'.format(shlex.join(tar_cmd), shlex.join(untar_cmd)))
+        tar_process = subprocess.Popen(tar_cmd,
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE)
+        untar_returncode = subprocess.call(untar_cmd,
+                                           stdin=tar_process.stdout,
+                                           stderr=subprocess.STDOUT)
+        tar_process.stdout.close()
+        if tar_process.wait() == 0 and untar_returncode == 0:
+            return
+        for name in names:
+            push_cmd = ['lxc', 'file', 'push', '-rp',
+                        os.path.join(directory, name),
+                        self.name + destination]
+            print(shlex.join(push_cmd))
+            subprocess.check_call(push_cmd,
+                                  stdin=subprocess.DEVNULL,
+                                  stderr=subprocess.STDOUT)
+
+    def push_code_directory(self, tmp_directory):
+        # A tar stream costs the same however many files the code has,
+        # while lxc file push makes a request per file
+        self.push_files(os.path.dirname(tmp_directory),
+                        [os.path.basename(tmp_directory)], '/tmp')
+
     def setup_code_directory(self, tmp_directory):
-        push_source_directory_cmd = 'lxc file push -rp {} {}'.format(tmp_directory,
-                                                               self.name + '/tmp')
-        print(push_source_directory_cmd)
-        subprocess.check_call(push_source_directory_cmd,
-                               stdin=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               shell=True)
-
-        push_ssh_directory_cmd = 'lxc file push {} -rp {}'.format(
-                                                       os.environ['HOME'] + '/.ssh',
-                                                       self.name + self.home)
-        print(push_ssh_directory_cmd)
-        subprocess.check_call(push_ssh_directory_cmd,
-                               stdin=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               shell=True)
-        push_git_config_directory_cmd = 'lxc file push {} -rp {}'.format(
-                                                       os.environ['HOME'] + '/.gitconfig',
-                                                       self.name + self.home)
-        print(push_git_config_directory_cmd)
-        subprocess.check_call(push_git_config_directory_cmd,
-                               stdin=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               shell=True)
+        # The pushes are independent of each other so run them both at once
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(self.push_code_directory, tmp_directory),
+                executor.submit(self.push_files, HOME,
+                                ['.ssh', '.gitconfig'], self.home)]
+            for future in as_completed(futures):
+                future.result()
         # need to change ownership for ssh to work
-        self.run_command('chown -R {0}:{0} {1}'.format(self.user, self.home))
-
-    def run_command(self, cmd):
-        lxc_command_output = ""
-        lxc_command = 'lxc exec {} -- {}'.format(self.name, cmd)
-        print("Running {}".format(lxc_command))
-        process = subprocess.Popen(lxc_command,
-                                   stdin=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   stdout=subprocess.PIPE,
-                                   shell=True)
-        while process.poll() is None:
-            process_output = process.stdout.readline().decode('utf-8')
-            print(process_output)
-            lxc_command_output += process_output
-        return process.returncode, lxc_command_output
+        self.run_command(['chown', '-R', '{0}:{0}'.format(self.user),
+                          self.home], live_output=False)
+
+    def _get_shell(self):
+        # All the commands are run by one long running shell in the container
+        # rather than by an lxc exec each
+        if self._shell is None:
+            self._shell = subprocess.Popen(
+                ['lxc', 'exec', self.name, '--', 'sh'],
+                stdin=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE)
+        return self._shell
+
+    def close(self):
+        """Exit the shell running the container's commands."""
+        if self._shell is not None:
+            self._shell.stdin.close()
+            self._shell.wait()
+            self._shell.stdout.close()
+            self._shell = None
+
+    def run_command(self, cmd, live_output=True):
+        """Run ``cmd`` in the container, given as a list or a string.
+
+        Strings are split the way a shell would and ``cmd`` is run in a
+        subshell of the container's shell, so it can't change the shell's
+        state. The output is printed as it's written unless ``live_output``
+        is unset, in which case it's printed once ``cmd`` exits.
+        """
+        lxc_command_output = []
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        lxc_command = ['lxc', 'exec', self.name, '--'] + cmd
+        print("Running {}".format(shlex.join(lxc_command)))
+        shell = self._get_shell()
+        # The shell writes the end marker and return code of cmd after its
+        # output, starting on a new line of its own
+        command_end_marker = RUN_COMMAND_END.format(uuid.uuid4().hex)
+        command_end_re = re.compile(
+            '\n{} ([0-9]+)\n'.format(command_end_marker).encode('utf-8'))
+        shell_command = '({}) </dev/null 2>&1; printf "\\n{} %d\\n" $?\n'
+        shell_command = shell_command.format(shlex.join(cmd),
+                                             command_end_marker)
+        shell.stdin.write(shell_command.encode('utf-8'))
+        shell.stdin.flush()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # Enough of the output is held back to be the start of the end marker
+        hold = len(command_end_marker) + 6
+        # Anything written after the end marker of the previous command, e.g.
+        # by a process it left running, is shown with this command's output
+        unread_output = self._unread_output
+        self._unread_output = b''
+        command_end = None
+        while command_end is None:
+            chunk = shell.stdout.read1(RUN_COMMAND_READ_SIZE)
+            if not chunk:
+                raise Exception('The shell running commands in {} '
+                                'exited'.format(self.name))
+            unread_output += chunk
+            command_end = command_end_re.search(unread_output)
+            if command_end is None:
+                process_output = decoder.decode(unread_output[:-hold])
+                unread_output = unread_output[-hold:]
+            else:
+                process_output = decoder.decode(
+                    unread_output[:command_end.start()], final=True)
+                self._unread_output = unread_output[command_end.end():]
+            if live_output:
+                print(process_output, end='', flush=True)
+            lxc_command_output.append(process_output)
+        if not live_output:
+            print(''.join(lxc_command_output), end='')
+        return int(command_end.group(1)), ''.join(lxc_command_output)
+
+
+@contextlib.contextmanager
+def lxc_container_pool():
+    """Keep the containers used by lxc_container until the context exits.
+
+    Each container is handed to the next lxc_container of the same
+    environment instead of being deleted, which skips launching it, waiting
+    for networking and pushing the ssh and git config again. The kept
+    containers are deleted on exit.
+    """
+    global _CONTAINER_POOL
+    _CONTAINER_POOL = defaultdict(list)
+    try:
+        yield
+    finally:
+        container_pool, _CONTAINER_POOL = _CONTAINER_POOL, None
+        for instances in container_pool.values():
+            for instance in instances:
+                instance.close()
+                _delete_container(instance.name)
+
+
+def _delete_container(name):
+    print("Deleting {}".format(name))
+    subprocess.check_call(['lxc', 'delete', '--force', name],
+                          stdin=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
 
 
 @contextlib.contextmanager
-def lxc_container(environment, cwd):
-    name = 'cpc-' + subprocess.check_output('petname',
-                                            stdin=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT,
-                                            shell=True).decode('utf-8').strip()
+def lxc_container(environment, cwd, strict_networking=False):
+    container_pool = _CONTAINER_POOL
+    if container_pool is not None and container_pool[environment]:
+        instance = container_pool[environment].pop()
+        name = instance.name
+    else:
+        instance = None
+        name = 'cpc-' + subprocess.check_output(
+            'petname', stdin=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    keep = False
     try:
-        instance = LxcContainer(environment, name)
-        instance.setup_code_directory(cwd)
+        if instance is None:
+            instance = LxcContainer(environment, name,
+                                    strict_networking=strict_networking)
+            instance.setup_code_directory(cwd)
+        else:
+            print("Reusing {}".format(name))
+            instance.push_code_directory(cwd)
         yield instance
+        if container_pool is not None:
+            # Containers are only reused if nothing went wrong in them and
+            # the code directory is removed so the next one starts clean
+            instance.run_command(['rm', '-rf', cwd], live_output=False)
+            container_pool[environment].append(instance)
+            keep = True
     finally:
-        print("Deleting {}".format(name))
-        subprocess.check_call('lxc delete --force {}'.format(name),
-                              stdin=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              shell=True)
+        if not keep:
+            if instance is not None:
+                instance.close()
+            _delete_container(name)
@@ -1,13 +1,11 @@
 import os
 from setuptools import find_packages, setup
-from glob import glob
-from os.path import basename
-from os.path import splitext
 
 reqs_path = os.path.join(os.path.dirname(__file__), 'requirements.txt')
 
 with open(reqs_path, 'r') as req_file:
-    dependencies = req_file.readlines()
+    dependencies = [line.strip() for line in req_file
+                    if line.strip() and not line.lstrip().startswith('#')]
 
 setup(
     name='lpshipit',
@@ -21,7 +19,7 @@ setup(
                 ' (only works for git repos)',
     packages=find_packages(),
     package_dir={'': '.'},
-    py_modules=[splitext(basename(path))[0] for path in glob('*.py')],
+    py_modules=['lpmpmessage', 'lpmptox', 'lpshipit', 'lxc'],
     include_package_data=True,
     entry_points={
         'console_scripts': [